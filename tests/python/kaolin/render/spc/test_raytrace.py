@@ -21,57 +21,111 @@ from kaolin.ops.spc import scan_octrees, generate_points, bits_to_uint8
 from kaolin.render.spc import unbatched_raytrace, mark_first_hit, \
                               unbatched_ray_aabb
 
-class TestRaytrace:
-    @pytest.fixture(autouse=True)
-    def octree(self):
-        bits_t = torch.tensor([
-            [0, 0, 0, 1, 0, 1, 1, 1],
-            [1, 1, 1, 1, 1, 1, 1, 1], [0, 0, 0, 0, 0, 0, 1, 1],
-                [0, 0, 0, 0, 0, 0, 0, 1], [ 0, 0, 0, 0, 0, 0, 0, 0]],
-            device='cuda', dtype=torch.float)
-        return bits_to_uint8(torch.flip(bits_t, dims=(-1,)))
+# Number of bytes of the octree used by TestRaytrace
+_LENGTH = torch.tensor([5], dtype=torch.int32)
 
-    @pytest.fixture(autouse=True)
-    def length(self, octree):
-        return torch.tensor([len(octree)], dtype=torch.int)
+@pytest.fixture(scope='module', autouse=True)
+def _cuda_warmup():
+    # Pay the CUDA lazy initialization before the first test rather than in it
+    torch.cuda.init()
+    torch.empty(1, device='cuda').add_(1)
+    torch.cuda.synchronize()
 
-    @pytest.fixture(autouse=True)
+def assert_cuda_equal(output, expected):
+    """Compare a CUDA output against a golden CPU tensor, on host"""
+    assert output.is_cuda
+    assert torch.equal(output.cpu(), expected)
+
+class TestRaytrace:
+    @pytest.fixture(scope='class')
+    def octree(self):
+        # Packed from the following bits (most significant bit first):
+        #     [0, 0, 0, 1, 0, 1, 1, 1],
+        #     [1, 1, 1, 1, 1, 1, 1, 1], [0, 0, 0, 0, 0, 0, 1, 1],
+        #         [0, 0, 0, 0, 0, 0, 0, 1], [ 0, 0, 0, 0, 0, 0, 0, 0]
+        # see test_octree_bits
+        return torch.tensor([23, 255, 3, 1, 0], dtype=torch.uint8, device='cuda')
+
+    @pytest.fixture(scope='class')
+    def length(self):
+        return _LENGTH
+
+    @pytest.fixture(scope='class')
     def max_level_pyramids_exsum(self, octree, length):
         return scan_octrees(octree, length)
 
-    @pytest.fixture(autouse=True)
+    @pytest.fixture(scope='class')
     def pyramid(self, max_level_pyramids_exsum):
         return max_level_pyramids_exsum[1].squeeze(0)
 
-    @pytest.fixture(autouse=True)
+    @pytest.fixture(scope='class')
     def exsum(self, max_level_pyramids_exsum):
         return max_level_pyramids_exsum[2]
 
-    @pytest.fixture(autouse=True)
+    @pytest.fixture(scope='class')
     def point_hierarchy(self, octree, pyramid, exsum):
         return generate_points(octree, pyramid.unsqueeze(0), exsum)
 
     def _generate_rays_origin (self, height, width, camera_dist):
         """Make simple orthographic rays"""
-        camera_dist = torch.tensor(camera_dist, dtype=torch.float, device='cuda')
-        camera_dist = camera_dist.repeat(height, width)
-        ii, jj = torch.meshgrid(
-            torch.arange(height, dtype=torch.float, device='cuda'),
-            torch.arange(width, dtype=torch.float, device='cuda'))
-        ii = (ii * 2. / height) - (height - 1.) / height
-        jj = (jj * 2. / width) - (width - 1.) / width
-        return torch.stack([ii, jj, camera_dist], dim=-1).reshape(-1, 3)
-
-    def test_raytrace_positive(self, octree, point_hierarchy, pyramid, exsum):
-        height = 4
-        width = 4
+        # Small enough to build on CPU and copy once
+        ii = torch.arange(height, dtype=torch.float) * (2. / height) - (height - 1.) / height
+        jj = torch.arange(width, dtype=torch.float) * (2. / width) - (width - 1.) / width
+        ii = ii.reshape(height, 1).expand(height, width)
+        jj = jj.reshape(1, width).expand(height, width)
+        return torch.stack([ii, jj, torch.full_like(ii, camera_dist)],
+                           dim=-1).reshape(-1, 3).cuda()
+
+    @pytest.fixture(scope='class')
+    def positive_rays(self):
+        origin = self._generate_rays_origin(4, 4, -3)
+        # Made contiguous once here, so the raytrace functions don't copy it on every call
         direction = torch.tensor([[0., 0., 1.]], dtype=torch.float,
-                                 device='cuda').repeat(height * width , 1)
-        origin = self._generate_rays_origin(height, width, -3)
-        nuggets = unbatched_raytrace(
+                                 device='cuda').expand(origin.shape[0], 3).contiguous()
+        return origin, direction
+
+    @pytest.fixture(scope='class')
+    def negative_rays(self):
+        origin = self._generate_rays_origin(4, 4, 3)
+        direction = torch.tensor([[0., 0., -1.]], dtype=torch.float,
+                                 device='cuda').expand(origin.shape[0], 3).contiguous()
+        return origin, direction
+
+    @pytest.fixture(scope='class')
+    def positive_nuggets(self, octree, point_hierarchy, pyramid, exsum, positive_rays):
+        origin, direction = positive_rays
+        return unbatched_raytrace(
             octree, point_hierarchy, pyramid, exsum, origin, direction, 2)
 
-        expected_nuggets = torch.tensor([
+    @pytest.fixture(scope='class')
+    def positive_first_hits(self, positive_nuggets):
+        return mark_first_hit(positive_nuggets)
+
+    @pytest.fixture(scope='class')
+    def negative_nuggets(self, octree, point_hierarchy, pyramid, exsum, negative_rays):
+        origin, direction = negative_rays
+        return unbatched_raytrace(
+            octree, point_hierarchy, pyramid, exsum, origin, direction, 2)
+
+    @pytest.fixture(scope='class')
+    def negative_first_hits(self, negative_nuggets):
+        return mark_first_hit(negative_nuggets)
+
+    @pytest.fixture(scope='class')
+    def positive_first_hit_idxes(self, positive_first_hits):
+        # nonzero syncs with the device, so only run it once per class
+        return torch.nonzero(positive_first_hits, as_tuple=False).int()
+
+    def test_octree_bits(self, octree):
+        bits_t = torch.tensor([
+            [0, 0, 0, 1, 0, 1, 1, 1],
+            [1, 1, 1, 1, 1, 1, 1, 1], [0, 0, 0, 0, 0, 0, 1, 1],
+                [0, 0, 0, 0, 0, 0, 0, 1], [ 0, 0, 0, 0, 0, 0, 0, 0]],
+            dtype=torch.float)
+        assert_cuda_equal(octree, bits_to_uint8(torch.flip(bits_t, dims=(-1,))))
+
+    @pytest.mark.parametrize('origin_rays,direction_rays,level,expected_nuggets', [
+        pytest.param('positive_rays', 'positive_rays', 2, torch.tensor([
             [ 0,  5],
             [ 0,  6],
             [ 0, 13],
@@ -82,19 +136,8 @@ class TestRaytrace:
             [ 4,  9],
             [ 4, 10],
             [ 5, 11],
-            [ 5, 12]], device='cuda', dtype=torch.int32)
-        assert torch.equal(nuggets, expected_nuggets)
-
-    def test_raytrace_negative(self, octree, point_hierarchy, pyramid, exsum):
-        height = 4
-        width = 4
-        direction = torch.tensor([[0., 0., -1.]], dtype=torch.float,
-                                 device='cuda').repeat(height * width , 1)
-        origin = self._generate_rays_origin(height, width, 3)
-        nuggets = unbatched_raytrace(
-            octree, point_hierarchy, pyramid, exsum, origin, direction, 2)
-
-        expected_nuggets = torch.tensor([
+            [ 5, 12]], dtype=torch.int32), id='positive'),
+        pytest.param('negative_rays', 'negative_rays', 2, torch.tensor([
             [ 0, 14],
             [ 0, 13],
             [ 0,  6],
@@ -105,31 +148,11 @@ class TestRaytrace:
             [ 4, 10],
             [ 4,  9],
             [ 5, 12],
-            [ 5, 11]], device='cuda', dtype=torch.int32)
-        assert torch.equal(nuggets, expected_nuggets)
-
-    def test_raytrace_none(self, octree, point_hierarchy, pyramid, exsum):
-        height = 4
-        width = 4
-        direction = torch.tensor([[0., 0., 1.]], dtype=torch.float,
-                                 device='cuda').repeat(height * width , 1)
-        origin = self._generate_rays_origin(height, width, 3)
-        nuggets = unbatched_raytrace(
-            octree, point_hierarchy, pyramid, exsum, origin, direction, 2)
-
-        expected_nuggets = torch.zeros((0, 2), device='cuda', dtype=torch.int32)
-        assert torch.equal(nuggets, expected_nuggets)
-
-    def test_raytrace_coarser(self, octree, point_hierarchy, pyramid, exsum):
-        height = 4
-        width = 4
-        direction = torch.tensor([[0., 0., 1.]], dtype=torch.float,
-                                 device='cuda').repeat(height * width , 1)
-        origin = self._generate_rays_origin(height, width, -3)
-        nuggets = unbatched_raytrace(
-            octree, point_hierarchy, pyramid, exsum, origin, direction, 1)
-
-        expected_nuggets = torch.tensor([
+            [ 5, 11]], dtype=torch.int32), id='negative'),
+        # rays pointing away from the octree
+        pytest.param('negative_rays', 'positive_rays', 2,
+                     torch.zeros((0, 2), dtype=torch.int32), id='none'),
+        pytest.param('positive_rays', 'positive_rays', 1, torch.tensor([
             [ 0,  1],
             [ 0,  2],
             [ 1,  1],
@@ -145,8 +168,15 @@ class TestRaytrace:
             [ 8,  4],
             [ 9,  4],
             [12,  4],
-            [13,  4]], device='cuda', dtype=torch.int32)
-        assert torch.equal(nuggets, expected_nuggets)
+            [13,  4]], dtype=torch.int32), id='coarser'),
+    ])
+    def test_raytrace(self, request, octree, point_hierarchy, pyramid, exsum,
+                      origin_rays, direction_rays, level, expected_nuggets):
+        origin, _ = request.getfixturevalue(origin_rays)
+        _, direction = request.getfixturevalue(direction_rays)
+        nuggets = unbatched_raytrace(
+            octree, point_hierarchy, pyramid, exsum, origin, direction, level)
+        assert_cuda_equal(nuggets, expected_nuggets)
 
     def test_ambiguous_raytrace(self):
         # TODO(cfujitsang): Is this actually desirable behavior?)
@@ -162,107 +192,63 @@ class TestRaytrace:
             [-1. / 3., -1. / 3., -1. / 3.]], dtype=torch.float, device='cuda')
         nuggets = unbatched_raytrace(
             octree, point_hierarchy, pyramids[0], exsum, origin, direction, 1)
-        expected_nuggets = torch.tensor([[1, 8], [1, 1]], device='cuda', dtype=torch.int32)
-        assert torch.equal(nuggets, expected_nuggets)
-
-    def test_mark_first_positive(self, octree, point_hierarchy, pyramid, exsum):
-        height = 4
-        width = 4
-        direction = torch.tensor([[0., 0., 1.]], dtype=torch.float,
-                                 device='cuda').repeat(height * width , 1)
-        origin = self._generate_rays_origin(height, width, -3)
-        nuggets = unbatched_raytrace(
-            octree, point_hierarchy, pyramid, exsum, origin, direction, 2)
-        first_hits = mark_first_hit(nuggets)
-        expected_first_hits = torch.tensor([1, 0, 0, 0, 1, 0, 1, 1, 0, 1, 0],
-                                           device='cuda', dtype=torch.bool)
-        assert torch.equal(first_hits, expected_first_hits)
+        expected_nuggets = torch.tensor([[1, 8], [1, 1]], dtype=torch.int32)
+        assert_cuda_equal(nuggets, expected_nuggets)
 
-    def test_mark_first_negative(self, octree, point_hierarchy, pyramid, exsum):
-        height = 4
-        width = 4
-        direction = torch.tensor([[0., 0., -1.]], dtype=torch.float,
-                                 device='cuda').repeat(height * width , 1)
-        origin = self._generate_rays_origin(height, width, 3)
-        nuggets = unbatched_raytrace(
-            octree, point_hierarchy, pyramid, exsum, origin, direction, 2)
-        first_hits = mark_first_hit(nuggets)
+    @pytest.mark.parametrize('sign', ['positive', 'negative'])
+    def test_mark_first(self, request, sign):
+        # Each ray id hits as many voxels in both orientations, so the first hits match
+        first_hits = request.getfixturevalue(f'{sign}_first_hits')
         expected_first_hits = torch.tensor([1, 0, 0, 0, 1, 0, 1, 1, 0, 1, 0],
-                                           device='cuda', dtype=torch.bool)
-        assert torch.equal(first_hits, expected_first_hits)
-
-    @pytest.mark.parametrize('with_first_hits', [False, True])
-    @pytest.mark.parametrize('with_first_hits_idxes', [False, True])
-    def test_ray_aabb(self, octree, point_hierarchy, pyramid, exsum,
+                                           dtype=torch.bool)
+        assert_cuda_equal(first_hits, expected_first_hits)
+
+    @pytest.mark.parametrize('with_first_hits', [False, True], ids=['no_fh', 'fh'])
+    @pytest.mark.parametrize('with_first_hits_idxes', [False, True],
+                             ids=['no_fh_idxes', 'fh_idxes'])
+    def test_ray_aabb(self, point_hierarchy, positive_rays, positive_nuggets,
+                      positive_first_hits, positive_first_hit_idxes,
                       with_first_hits, with_first_hits_idxes):
-        height = 4
-        width = 4
-        direction = torch.tensor([[0., 0., 1.]], dtype=torch.float,
-                                 device='cuda').repeat(height * width , 1)
-        origin = self._generate_rays_origin(height, width, -3)
-        nuggets = unbatched_raytrace(
-            octree, point_hierarchy, pyramid, exsum, origin, direction, 2)
-
-        if with_first_hits:
-            first_hits = mark_first_hit(nuggets)
-        else:
-            first_hits = None
+        origin, direction = positive_rays
 
-        if with_first_hits_idxes:
-            tmp_first_hits = mark_first_hit(nuggets)
-            first_hit_idxes = torch.nonzero(tmp_first_hits, as_tuple=False).int()
-        else:
-            first_hit_idxes = None
+        first_hits = positive_first_hits if with_first_hits else None
+        first_hit_idxes = positive_first_hit_idxes if with_first_hits_idxes else None
 
-        dist, corresp, out_mask = unbatched_ray_aabb(nuggets, point_hierarchy, origin,
-                                                     direction, 2, info=first_hits,
+        dist, corresp, out_mask = unbatched_ray_aabb(positive_nuggets, point_hierarchy,
+                                                     origin, direction, 2, info=first_hits,
                                                      info_idxes=first_hit_idxes)
         expected_dist = torch.tensor([[2.], [2.], [2.], [0.], [2.], [2.], [0.], [0.],
-                                      [0.], [0.], [0.], [0.], [0.], [0.], [0.], [0.]],
-                                     device='cuda')
+                                      [0.], [0.], [0.], [0.], [0.], [0.], [0.], [0.]])
         expected_corresp = torch.tensor([5, 7, 15, -1, 9, 11, -1, -1, -1, -1, -1, -1, -1,
-                                         -1, -1, -1], dtype=torch.int32, device='cuda')
+                                         -1, -1, -1], dtype=torch.int32)
         expected_out_mask = torch.tensor([1, 1, 1, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                         dtype=torch.bool, device='cuda')
-        assert torch.equal(dist, expected_dist)
-        assert torch.equal(corresp, expected_corresp)
-        assert torch.equal(out_mask, expected_out_mask)
-
-    @pytest.mark.parametrize('with_first_hits', [False, True])
-    @pytest.mark.parametrize('with_first_hits_idxes', [False, True])
-    def test_ray_aabb_with_mask(self, octree, point_hierarchy, pyramid, exsum,
+                                         dtype=torch.bool)
+        assert_cuda_equal(dist, expected_dist)
+        assert_cuda_equal(corresp, expected_corresp)
+        assert_cuda_equal(out_mask, expected_out_mask)
+
+    @pytest.mark.parametrize('with_first_hits', [False, True], ids=['no_fh', 'fh'])
+    @pytest.mark.parametrize('with_first_hits_idxes', [False, True],
+                             ids=['no_fh_idxes', 'fh_idxes'])
+    def test_ray_aabb_with_mask(self, point_hierarchy, positive_rays, positive_nuggets,
+                                positive_first_hits, positive_first_hit_idxes,
                                 with_first_hits, with_first_hits_idxes):
-        height = 4
-        width = 4
-        direction = torch.tensor([[0., 0., 1.]], dtype=torch.float,
-                                 device='cuda').repeat(height * width , 1)
-        origin = self._generate_rays_origin(height, width, -3)
+        origin, direction = positive_rays
         mask = torch.tensor([0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
                             dtype=torch.bool, device='cuda')
-        nuggets = unbatched_raytrace(
-            octree, point_hierarchy, pyramid, exsum, origin, direction, 2)
-
-        if with_first_hits:
-            first_hits = mark_first_hit(nuggets)
-        else:
-            first_hits = None
 
-        if with_first_hits_idxes:
-            tmp_first_hits = mark_first_hit(nuggets)
-            first_hit_idxes = torch.nonzero(tmp_first_hits, as_tuple=False).int()
-        else:
-            first_hit_idxes = None
+        first_hits = positive_first_hits if with_first_hits else None
+        first_hit_idxes = positive_first_hit_idxes if with_first_hits_idxes else None
 
-        dist, corresp, out_mask = unbatched_ray_aabb(nuggets, point_hierarchy, origin,
-                                                     direction, 2, info=first_hits,
+        dist, corresp, out_mask = unbatched_ray_aabb(positive_nuggets, point_hierarchy,
+                                                     origin, direction, 2, info=first_hits,
                                                      info_idxes=first_hit_idxes, mask=mask)
         expected_dist = torch.tensor([[0.], [0.], [2.], [0.], [2.], [2.], [0.], [0.],
-                                      [0.], [0.], [0.], [0.], [0.], [0.], [0.], [0.]],
-                                     device='cuda')
+                                      [0.], [0.], [0.], [0.], [0.], [0.], [0.], [0.]])
         expected_corresp = torch.tensor([-1, -1, 15, -1, 9, 11, -1, -1, -1, -1, -1, -1, -1,
-                                         -1, -1, -1], dtype=torch.int32, device='cuda')
+                                         -1, -1, -1], dtype=torch.int32)
         expected_out_mask = torch.tensor([0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
-                                         dtype=torch.bool, device='cuda')
-        assert torch.equal(dist, expected_dist)
-        assert torch.equal(corresp, expected_corresp)
-        assert torch.equal(out_mask, expected_out_mask)
+                                         dtype=torch.bool)
+        assert_cuda_equal(dist, expected_dist)
+        assert_cuda_equal(corresp, expected_corresp)
+        assert_cuda_equal(out_mask, expected_out_mask)